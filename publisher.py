@@ -1,18 +1,36 @@
+import re
 import sys
-import json
+import time
+import queue
 import logging
-import fileinput
+import functools
+import threading
 import subprocess
-from os import environ
+from os import environ, read
 
 from dateutil import parser
 from tzlocal import get_localzone
-from google.cloud import pubsub
-from google.api_core import exceptions
+
+from serialization import dumps
+from publisher_core import (make_publisher_client, get_or_create_topic,
+    make_stats, callback, report_stats)
 
 IFACE = 'hci0'
 REPLACE_CONSTRUCTORS = set(['Static', 'Resolvable', 'Non-Resolvable'])
 TIMEZONE = get_localzone()
+PUBLISH_QUEUE_SIZE = 10000
+READ_SIZE = 1 << 16
+PERSIST_BUFFER_SIZE = 1 << 20
+PERSIST_FLUSH_SECONDS = 0.5
+# btmon messages start with a line beginning with '>' or '<'
+MSG_START_RE = re.compile(rb'^[<>]', re.M)
+# Fields of an LE Advertising Report, `lastgroup` tells which one matched
+FIELD_RE = re.compile(
+    rb'^        (?:'
+    rb'(?P<address>Address:(?P<addr>[^(\n]*)(?:\((?P<ctor>.*)\))?)'
+    rb'|(?P<company>Company:(?P<co>[^(\n]*))'
+    rb'|(?P<rssi>RSSI: *(?P<dbm>-?\d+)?)'
+    rb')', re.M)
 
 logging.basicConfig(
     stream=sys.stdout, level=logging.INFO,
@@ -34,51 +52,35 @@ except KeyError as exc:
 else:
     logging.info('Writting data locally to ' + PERSIST_STORE)
 
-def get_or_create_topic(pub_client, gcloud_project_id, gcloud_topic_name):
-    '''
-    Create or get an existing topic from Google PubSub.
-
-    If the topic already exists we just get an handle to it. If the topic does
-    not already exist then it is created and an handle to it is returned.
+stats = make_stats()
 
-    If an error occurs during topic creation we exit the program.
-
-    Parameters
-    ----------
-    pub_client : google.cloud.pubsub.PublisherClient
-        Google Pubsub publisher client.
-    gcloud_project_id : str
-        Google Cloud project id.
-    gcloud_topic_name : str
-        Google PubSub topic name.
-
-    Returns
-    -------
-    str : project/topic in Google Cloud URI format
+def publish_worker(pub_client, topic, publish_queue):
     '''
-    topic = pub_client.topic_path(gcloud_project_id, gcloud_topic_name)
-    try:
-        response = pub_client.create_topic(topic)
-    except exceptions.AlreadyExists as exc:
-        logging.info('Topic %s already exists' % topic)
-    except Exception as exc:
-        logging.exception('Unable to create or get topic: %s' % topic)
-        sys.exit(1)
-    else:
-        logging.info('Created topic %s' % topic)
-    return topic
+    Publish serialized messages taken from `publish_queue` to PubSub.
 
-def callback(future):
-    try:
-        message_id = future.result()
-    except Exception as exc:
-        logging.warning('Unable to publish message')
-    else:
-        logging.info('Published message: ' + message_id)
+    This runs in its own thread so that reading `btmon` output never waits on
+    the PubSub client.
+    '''
+    while True:
+        msg_serialized = publish_queue.get()
+        try:
+            future = pub_client.publish(topic, msg_serialized)
+            # TODO: add message attributes (event time, publish time)
+            future.add_done_callback(functools.partial(callback, stats))
+        except Exception as exc:
+            logging.exception('Unable to publish message: %s' % msg_serialized)
+        else:
+            stats['published'] += 1
+            report_stats(stats)
+        finally:
+            publish_queue.task_done()
 
 def get_sniffer_addr(iface):
     '''
-    Parse output of `hcitool dev` command to get `iface` bdaddr.
+    Get `iface` bdaddr.
+
+    The address is read from sysfs when the kernel exposes it there, otherwise
+    we fall back to parsing the output of `hcitool dev` command.
 
     Parameters
     ----------
@@ -89,6 +91,12 @@ def get_sniffer_addr(iface):
     -------
     str : bdaddr of `iface`
     '''
+    try:
+        with open('/sys/class/bluetooth/%s/address' % iface) as f:
+            return f.read().strip().lower()
+    except OSError:
+        pass
+
     result = subprocess.run(['hcitool', 'dev'], 
         stdout=subprocess.PIPE)
     addr = result.stdout.decode()
@@ -100,6 +108,14 @@ def get_sniffer_addr(iface):
                 return baddr.strip().lower()
 
 sniffer_addr = get_sniffer_addr(IFACE)
+# Every parsed message starts as a copy of this dict
+MSG_TEMPLATE = {
+    'sniffer_addr': sniffer_addr,
+    'datetime': None,
+    'adv_constructor': None,
+    'adv_addr': None,
+    'rssi': None,
+}
 
 def parse_message(msg):
     '''
@@ -107,101 +123,120 @@ def parse_message(msg):
 
     Parameters
     ----------
-    msg : str
+    msg : bytes
 
     Returns
     -------
     dict or None
     '''
-    lines = msg.split('\n')
-    type_ = lines[1].strip()
-    if not type_.startswith('LE Advertising Report'):
+    # Reject other events by looking at the second line only
+    header_end = msg.find(b'\n')
+    type_end = msg.find(b'\n', header_end + 1)
+    type_ = msg[header_end + 1:type_end].lstrip()
+    if not type_.startswith(b'LE Advertising Report'):
         return None
 
-    data = dict()
-    data['sniffer_addr'] = sniffer_addr
-    data['datetime'] = parser.parse(lines[0][-26:])
+    data = MSG_TEMPLATE.copy()
+    data['datetime'] = parser.parse(msg[:header_end][-26:].decode())
     data['datetime'] = TIMEZONE.localize(data['datetime']).timestamp()
-    for line in lines[2:]:
-        if line.startswith('        Address:'):
-            _, addr = line.split(':', 1)
-            constructor = addr[addr.find('('):addr.rfind(')')+1]
-            data['adv_constructor'] = constructor.replace('(', '').replace(')', '')
-            data['adv_addr'] = addr.replace(constructor, '').strip().lower()
-        if line.startswith('        Company:'):
-            _, company = line.split(':', 1)
-            rm = company[company.find('('):company.find(')')+1]
-            if 'adv_constructor' in data:
-                if data['adv_constructor'] in REPLACE_CONSTRUCTORS:
-                    data['adv_constructor'] = company.replace(rm, '').strip()
-        if line.startswith('        RSSI:'):
-            _, rssi = line.split(':', 1)
-            rssi = rssi[:-6].replace('dBm', '').strip()
-            try:
-                data['rssi'] = int(rssi)
-            except ValueError:
-                data['rssi'] = None
+    for m in FIELD_RE.finditer(msg):
+        field = m.lastgroup
+        if field == 'address':
+            constructor = m.group('ctor') or b''
+            constructor = constructor.replace(b'(', b'').replace(b')', b'')
+            data['adv_constructor'] = constructor.decode(errors='replace')
+            data['adv_addr'] = m.group('addr').strip().lower().decode()
+        elif field == 'company':
+            if data['adv_constructor'] in REPLACE_CONSTRUCTORS:
+                company = m.group('co').strip()
+                data['adv_constructor'] = company.decode(errors='replace')
+        elif field == 'rssi':
+            rssi = m.group('dbm')
+            data['rssi'] = int(rssi) if rssi is not None else None
 
     return data
 
-def process_message(msg, pub_client, topic, persist_store):
+def process_message(msg, publish_queue, persist_store):
     # Parse message
     try:
         msg_parsed = parse_message(msg)
     except Exception as exc:
-        logging.exception('Unable to parse message:\n%s' % msg)
+        logging.exception('Unable to parse message:\n%s' %
+            msg.decode(errors='replace'))
         return
 
     # Serialize message to JSON
     if msg_parsed is None:
         return
-    msg_serialized = json.dumps(msg_parsed, separators=(',', ':'))
+    msg_serialized = dumps(msg_parsed)
 
     # Write message to local persistent store
     try:
         if persist_store:
-            persist_store.write(msg_serialized + '\n')
-            persist_store.flush()
+            persist_store.write(msg_serialized + b'\n')
     except Exception as exc:
         logging.exception('Unable to locally write message: %s' % msg_serialized)
 
-    # Write message to google pubsub
+    # Hand message over to the google pubsub worker, drop it if it lags behind
     try:
-        future = pub_client.publish(topic, msg_serialized.encode())
-        # TODO: add message attributes (event time, publish time)
-        future.add_done_callback(callback)
-    except Exception as exc:
-        logging.exception('Unable to publish message: %s' % msg_serialized)
+        publish_queue.put_nowait(msg_serialized)
+    except queue.Full:
+        stats['dropped'] += 1
 
     return
 
-def loop(pub_client, topic, persist_store):
+def loop(publish_queue, persist_store):
     '''
-    Main loop reading from stdin, parsing messages and sending them to PubSub.
+    Main loop reading from stdin, parsing messages and queuing them for PubSub.
+
+    Stdin is read in blocks of up to `READ_SIZE` bytes. Complete messages are
+    processed as soon as the start of the next one is seen, the remaining data
+    is kept until more input is available.
+
+    The local persistent store is flushed at most every
+    `PERSIST_FLUSH_SECONDS` seconds rather than after each message.
     '''
-    inside_msg = False
-    msg = ''
-    for line in fileinput.input():
-        if line.startswith('>') or line.startswith('<'):
-            if inside_msg:
-                process_message(msg, pub_client, topic, persist_store)
-            msg = line
-            inside_msg = True
-        elif inside_msg:
-            msg += line
+    fd = sys.stdin.fileno()
+    pending = b''
+    flushed_at = time.time()
+    while True:
+        chunk = read(fd, READ_SIZE)
+        if not chunk:
+            break
+        if persist_store and time.time() - flushed_at >= PERSIST_FLUSH_SECONDS:
+            try:
+                persist_store.flush()
+            except Exception as exc:
+                logging.exception('Unable to flush local persistent store')
+            flushed_at = time.time()
+        pending += chunk
+        starts = [m.start() for m in MSG_START_RE.finditer(pending)]
+        if not starts:
+            # Not inside a message: only keep the last incomplete line
+            pending = pending[pending.rfind(b'\n') + 1:]
+            continue
+        for start, end in zip(starts, starts[1:]):
+            process_message(pending[start:end], publish_queue, persist_store)
+        pending = pending[starts[-1]:]
 
 if __name__ == '__main__':
     logging.info('Starting sniffer ...')
     logging.info('Sniffing interface: %s (%s)' % (IFACE, sniffer_addr))
 
-    pub_client = pubsub.PublisherClient()
+    pub_client = make_publisher_client()
     topic = get_or_create_topic(pub_client, GCLOUD_PROJECT_ID,
         GCLOUD_TOPIC_NAME)
-    persist_store = open(PERSIST_STORE, 'a') if PERSIST_STORE else None
+    persist_store = open(PERSIST_STORE, 'ab', buffering=PERSIST_BUFFER_SIZE) \
+        if PERSIST_STORE else None
+    publish_queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+    threading.Thread(target=publish_worker,
+        args=(pub_client, topic, publish_queue), daemon=True).start()
 
     try:
-        loop(pub_client, topic, persist_store)
+        loop(publish_queue, persist_store)
+        publish_queue.join()
     except KeyboardInterrupt:
         logging.info('Interrupted. Exiting ...')
+    finally:
         if persist_store:
             persist_store.close()
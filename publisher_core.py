@@ -0,0 +1,94 @@
+'''
+Google PubSub publishing code shared by `publisher.py` and
+`publisher_simulator.py`.
+'''
+import sys
+import time
+import logging
+
+from google.cloud import pubsub
+from google.api_core import exceptions
+
+BATCH_SETTINGS = pubsub.types.BatchSettings(
+    max_bytes=1 << 20, max_latency=0.05, max_messages=1000)
+STATS_MESSAGES = 1000
+STATS_SECONDS = 60
+
+def make_publisher_client():
+    '''
+    Create a Google PubSub publisher client batching messages according to
+    `BATCH_SETTINGS`.
+
+    Returns
+    -------
+    google.cloud.pubsub.PublisherClient
+    '''
+    return pubsub.PublisherClient(batch_settings=BATCH_SETTINGS)
+
+def get_or_create_topic(pub_client, gcloud_project_id, gcloud_topic_name):
+    '''
+    Create or get an existing topic from Google PubSub.
+
+    If the topic already exists we just get an handle to it. If the topic does
+    not already exist then it is created and an handle to it is returned.
+
+    If an error occurs during topic creation we exit the program.
+
+    Parameters
+    ----------
+    pub_client : google.cloud.pubsub.PublisherClient
+        Google Pubsub publisher client.
+    gcloud_project_id : str
+        Google Cloud project id.
+    gcloud_topic_name : str
+        Google PubSub topic name.
+
+    Returns
+    -------
+    str : project/topic in Google Cloud URI format
+    '''
+    topic = pub_client.topic_path(gcloud_project_id, gcloud_topic_name)
+    try:
+        response = pub_client.create_topic(topic)
+    except exceptions.AlreadyExists as exc:
+        logging.info('Topic %s already exists' % topic)
+    except Exception as exc:
+        logging.exception('Unable to create or get topic: %s' % topic)
+        sys.exit(1)
+    else:
+        logging.info('Created topic %s' % topic)
+    return topic
+
+def make_stats():
+    '''
+    Create publication counters used by `callback` and `report_stats`.
+
+    Returns
+    -------
+    dict
+    '''
+    return {'published': 0, 'errors': 0, 'dropped': 0, 'reported_at': time.time()}
+
+def callback(stats, future):
+    '''
+    Count messages which could not be published.
+
+    Successful publications are not logged one by one, see `report_stats`.
+    '''
+    try:
+        future.result()
+    except Exception as exc:
+        stats['errors'] += 1
+
+def report_stats(stats):
+    '''
+    Log publication counters every `STATS_MESSAGES` messages or at least
+    every `STATS_SECONDS` seconds.
+    '''
+    now = time.time()
+    if stats['published'] % STATS_MESSAGES and \
+            now - stats['reported_at'] < STATS_SECONDS:
+        return
+    stats['reported_at'] = now
+    logging.info('Published %d messages, %d errors, %d dropped' %
+        (stats['published'], stats['errors'], stats['dropped']))
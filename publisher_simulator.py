@@ -2,19 +2,22 @@ from os import environ
 from sys import exit, stdout
 from hashlib import sha1
 import time
-import json
 import random
+import asyncio
 import logging
+import functools
 
-from google.cloud import pubsub
-from google.api_core import exceptions
+from publisher_core import (make_publisher_client, get_or_create_topic,
+    make_stats, callback, report_stats)
 
 # Configure
 logging.basicConfig(
     stream=stdout, level=logging.INFO,
     format='%(module)s|%(name)s|%(filename)s - %(levelname)s @ %(asctime)s : %(message)s'
 )
-random.seed(42)
+RANDOM_SEED = 42
+N_STATIONS = 10
+N_BEACONS = 100
 
 # Get configuration
 try:
@@ -32,93 +35,94 @@ except KeyError as exc:
 else:
     logging.info(f'Writting data locally to {PERSIST_STORE}')
 
-def get_or_create_topic(pub_client, gcloud_project_id, gcloud_topic_name):
-    '''
-    Create or get an existing topic from Google PubSub.
+def generate_mac_addr(k, type_):
+    h = sha1()
+    h.update(type_.encode())
+    h.update(str(k).encode())
+    digest = h.hexdigest()
+    addr = ':'.join([digest[2*i:2*(i+1)] for i in range(6)])
+    return addr
+
+def adv_fields(k):
+    adv_addr = generate_mac_addr(k, 'adv')
+    adv_constructor = adv_addr.replace(':', '').upper()
+    return f'"adv_addr":"{adv_addr}","adv_constructor":"{adv_constructor}"'
+
+def sniffer_fields(k):
+    return f'"sniffer_addr":"{generate_mac_addr(k, "sniffer")}"'
 
-    If the topic already exists we just get an handle to it. If the topic does
-    not already exist then it is created and an handle to it is returned.
+# JSON fragments of the constant fields, precomputed for every address
+ADV_FIELDS = [adv_fields(k) for k in range(N_STATIONS)]
+SNIFFER_FIELDS = [sniffer_fields(k) for k in range(N_BEACONS)]
 
-    If an error occurs during topic creation we exit the program.
+def generate(randrange, now=time.time):
+    '''
+    Generate a random message already serialized to JSON.
+
+    The message is built from the precomputed `ADV_FIELDS` and
+    `SNIFFER_FIELDS` fragments so that no JSON encoder is involved.
 
     Parameters
     ----------
-    pub_client : google.cloud.pubsub.PublisherClient
-        Google Pubsub publisher client.
-    gcloud_project_id : str
-        Google Cloud project id.
-    gcloud_topic_name : str
-        Google PubSub topic name.
+    randrange : callable
+        `randrange` method of the `random.Random` instance to draw from.
+    now : callable
+        Clock giving the message datetime.
 
     Returns
     -------
-    str : project/topic in Google Cloud URI format
+    bytes : JSON serialized message
     '''
-    topic = pub_client.topic_path(gcloud_project_id, gcloud_topic_name)
-    try:
-        response = pub_client.create_topic(topic)
-    except exceptions.AlreadyExists as exc:
-        logging.info(f'Topic {topic} already exists')
-    except Exception as exc:
-        logging.exception(f'Unable to create or get topic: {topic}')
-        exit(1)
-    else:
-        logging.info(f'Created topic {topic}')
-    return topic
+    adv = ADV_FIELDS[randrange(N_STATIONS)]
+    sniffer = SNIFFER_FIELDS[randrange(N_BEACONS)]
+    rssi = randrange(-80, 80)
+    msg = (f'{{{adv},{sniffer},'
+        f'"rssi":{rssi},"datetime":{now()}}}')
+    return msg.encode()
 
-def callback(future):
-    try:
-        message_id = future.result()
-    except Exception as exec:
-        logging.warning(f'Unable to publish message')
-    else:
-        logging.info(f'Published message: {message_id}')
+async def loop(pub_client, topic, persist_store):
+    '''
+    Publish one generated message every `SIMULATOR_WAIT_SECONDS` seconds.
 
-def generate_mac_addr(k, type_):
-    h = sha1()
-    h.update(type_.encode())
-    h.update(str(k).encode())
-    digest = h.hexdigest()
-    addr = ':'.join([digest[2*i:2*(i+1)] for i in range(6)])
-    return addr
+    Messages are scheduled against the event loop clock so that the time spent
+    generating and publishing does not delay the next message.
+    '''
+    # Bind everything used in the loop to locals to avoid attribute lookups
+    randrange = random.Random(RANDOM_SEED).randrange
+    publish = pub_client.publish
+    persist = persist_store.write if persist_store else None
+    sleep = asyncio.sleep
+    clock = asyncio.get_event_loop().time
+    wait_seconds = SIMULATOR_WAIT_SECONDS
+    stats = make_stats()
+    done_callback = functools.partial(callback, stats)
+    next_at = clock()
+    while True:
+        msg = generate(randrange)
+        # write to local persistent store
+        if persist:
+            persist(msg + b'\n')
+        # write to google pubsub, the client sends it from its own threads
+        future = publish(topic, msg)
+        future.add_done_callback(done_callback)
+        stats['published'] += 1
+        report_stats(stats)
+        next_at += wait_seconds
+        await sleep(next_at - clock())
 
-def generate(n_stations, n_beacons):
-    adv_addr = generate_mac_addr(random.randrange(n_stations), 'adv')
-    adv_constructor = adv_addr.replace(':', '').upper()
-    sniffer_addr = generate_mac_addr(random.randrange(n_beacons), 'sniffer')
-    msg = {
-        'adv_addr': adv_addr,
-        'adv_constructor': adv_constructor,
-        'sniffer_addr': sniffer_addr,
-        'rssi': random.randrange(-80, 80),
-        'datetime': time.time()
-    }
-    return msg
+if __name__ == '__main__':
+    pub_client = make_publisher_client()
+    topic = get_or_create_topic(pub_client, 
+        GCLOUD_PROJECT_ID, GCLOUD_TOPIC_NAME)
+    persist_store = open(PERSIST_STORE, 'ab', buffering=0) if PERSIST_STORE else None
 
-def loop(pub_client, topic, persist_store):
+    logging.info('Starting publishing messages...')
+    event_loop = asyncio.get_event_loop()
     try:
-        while True:
-            msg = generate(10, 100)
-            msg = json.dumps(msg, separators=(',', ':'))
-            # write to local persistent store
-            if persist_store:
-                persist_store.write(msg + '\n')
-            # write to google pubsub
-            future = pub_client.publish(topic, msg.encode())
-            future.add_done_callback(callback)
-            time.sleep(SIMULATOR_WAIT_SECONDS)
+        event_loop.run_until_complete(loop(pub_client, topic, persist_store))
     except KeyboardInterrupt as exc:
         logging.info('Interrupted. Exiting...')
         if persist_store:
             persist_store.close()
             logging.info('Closed local persistent store file')
         exit(0)
-
-if __name__ == '__main__':
-    pub_client = pubsub.PublisherClient()
-    topic = get_or_create_topic(pub_client, 
-        GCLOUD_PROJECT_ID, GCLOUD_TOPIC_NAME)
-    persist_store = open(PERSIST_STORE, 'a', buffering=1) if PERSIST_STORE else None
-
-    logging.info('Starting publishing messages...')
-    loop(pub_client, topic, persist_store)
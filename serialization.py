@@ -0,0 +1,19 @@
+'''
+JSON serialization shared by publishers and subscribers.
+
+`orjson` is used when it is installed, otherwise we fall back to the standard
+library `json` module. In both cases `dumps` returns compact JSON as `bytes`
+and `loads` accepts either `bytes` or `str`.
+'''
+try:
+    import orjson
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    loads = json.loads
+else:
+    dumps = orjson.dumps
+    loads = orjson.loads
@@ -1,17 +1,21 @@
-import json
 import logging
 from os import environ
 from sys import stderr, exit
 
-from redis import StrictRedis
+from redis import StrictRedis, BlockingConnectionPool
 from google.cloud import pubsub
 from google.api_core import exceptions
 
+from serialization import loads
+
 # Configure
 logging.basicConfig(
     stream=stderr, level=logging.INFO,
     format='%(module)s|%(name)s|%(filename)s - %(levelname)s @ %(asctime)s : %(message)s'
 )
+logger = logging.getLogger(__name__)
+# Callbacks run concurrently in the subscriber's thread pool
+REDIS_MAX_CONNECTIONS = 32
 
 # Get configuration
 try:
@@ -22,10 +26,10 @@ try:
     REDIS_MASTER_PORT = int(environ['REDIS_MASTER_PORT'])
     REDIS_PASSWORD = environ['REDIS_PASSWORD']
 except KeyError as exc:
-    logging.error(f'Please provide environment variable {exc.args[0]}')
+    logger.error(f'Please provide environment variable {exc.args[0]}')
     exit(1)
 except ValueError as exc: # int parsing
-    logging.exception(
+    logger.exception(
         f'Unable to parse port number: {environ["REDIS_MASTER_PORT"]}')
     exit(1)
 
@@ -52,60 +56,98 @@ def get_or_create_subscription(client, project_id, topic_name, sub_name):
     try:
         response = client.create_subscription(subscription, topic)
     except exceptions.AlreadyExists as exc:
-        logging.info(
+        logger.info(
             f'Subscription {subscription} already exists'
         )
     except Exception as exc:
-        logging.exception(
+        logger.exception(
             f'Unable to create or get subscription: {subscription}'
         )
         exit(1)
     else:
-        logging.info(f'Created subscription {subscription}')
+        logger.info(f'Created subscription {subscription}')
     return subscription
 
 def make_redis(host, port, password):
     try:
-        redis = StrictRedis(host, port, password=password)
+        pool = BlockingConnectionPool(host=host, port=port, password=password,
+            max_connections=REDIS_MAX_CONNECTIONS, socket_keepalive=True)
+        redis = StrictRedis(connection_pool=pool)
         assert redis.ping()
     except Exception as exc:
-        logging.exception('Unable to connect to redis')
+        logger.exception('Unable to connect to redis')
         exit(1)
     return redis
 
+# The first half of KEYS are message keys and the second half the matching
+# datetime keys. Every message key is set to ARGV[1], and its datetime key to
+# ARGV[2], unless it already holds a newer message. Datetimes are read from
+# the datetime keys so that stored messages are not decoded, except for
+# message keys written before datetime keys existed. Returns one status per
+# message key, see UPSERT_LOGS.
+UPSERT_SCRIPT = '''
+local statuses = {}
+local n = #KEYS / 2
+local datetime = tonumber(ARGV[2])
+for i = 1, n do
+    local key, datetime_key = KEYS[i], KEYS[n + i]
+    local status = 1
+    local current = redis.call('GET', datetime_key)
+    if current then
+        status = 2
+        current = tonumber(current)
+    else
+        local value = redis.call('GET', key)
+        if value then
+            status = 2
+            current = cjson.decode(value).datetime
+        end
+    end
+    if current and current > datetime then
+        statuses[i] = 0
+    else
+        redis.call('SET', key, ARGV[1])
+        redis.call('SET', datetime_key, ARGV[2])
+        statuses[i] = status
+    end
+end
+return statuses
+'''
+UPSERT_LOGS = ('Received older key', 'Created key', 'Updated key')
+DATETIME_KEY_PREFIX = 'datetime:'
+
 redis = make_redis(REDIS_MASTER_HOST, REDIS_MASTER_PORT, REDIS_PASSWORD)
+upsert_script = redis.register_script(UPSERT_SCRIPT)
 
-def _upsert(key, value):
-    value_dict = json.loads(value)
-    current = redis.get(key)
-    if current is None:
-        logging.info(f'Created key {key}')
-        redis.set(key, value)
-    else:
-        current_dict = json.loads(current)
-        if value_dict['datetime'] >= current_dict['datetime']:
-            logging.info(f'Updated key {key}')
-            redis.set(key, value)
-        else:
-            logging.info(f'Received older key {key}')
+def _upsert(keys, value, datetime):
+    '''
+    Atomically upsert `value` in all `keys` with a single Redis round-trip.
+
+    The datetime of the message stored in each key is kept in the sibling key
+    `DATETIME_KEY_PREFIX + key`.
+    '''
+    datetime_keys = [DATETIME_KEY_PREFIX + key for key in keys]
+    statuses = upsert_script(keys=keys + datetime_keys, args=[value, datetime])
+    if logger.isEnabledFor(logging.DEBUG):
+        for key, status in zip(keys, statuses):
+            logger.debug('%s %s', UPSERT_LOGS[status], key)
 
 def callback(message):
-    logging.info(f'Processing message {message.message_id} ...')
-    data = json.loads(message.data)
+    logger.debug('Processing message %s ...', message.message_id)
+    data = loads(message.data)
 
     station_key = 'sniffer_addr:' + str(data['sniffer_addr'])
     beacon_key = 'adv_addr:' + str(data['adv_addr'])
     station_beacon_key = ','.join([station_key, beacon_key])
 
     try:
-        _upsert(station_key, message.data)
-        _upsert(beacon_key, message.data)
-        _upsert(station_beacon_key, message.data)
+        _upsert([station_key, beacon_key, station_beacon_key], message.data,
+            data['datetime'])
     except Exception as exc:
-        logging.exception('Unable to upsert')
+        logger.exception('Unable to upsert')
     else:
         message.ack()
-        logging.info(f'Acknowledged message {message.message_id}')
+        logger.debug('Acknowledged message %s', message.message_id)
 
 if __name__ == '__main__':
     subscriber = pubsub.SubscriberClient()
@@ -117,10 +159,10 @@ if __name__ == '__main__':
     try:
         future.result()
     except KeyboardInterrupt as exc:
-        logging.info('Interrupted. Exiting...')
+        logger.info('Interrupted. Exiting...')
         subscription.close()
         exit(0)
     except Exception as exc:
-        logging.exception(f'Subscriber failed. Exiting...')
+        logger.exception(f'Subscriber failed. Exiting...')
         subscription.close()
         exit(1)